@@ -7,6 +7,7 @@ from mypermobil.mypermobil import (
 from mypermobil.exceptions import (
     MyPermobilException,
     MyPermobilAPIException,
+    MyPermobilServerException,
     MyPermobilEulaException,
     MyPermobilClientException,
     MyPermobilNoProductException,
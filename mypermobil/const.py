@@ -143,6 +143,6 @@ ITEM_LOOKUP = {
 # when multiple endpoints have the same item, the FIRST one in the list will be used
 ENDPOINT_LOOKUP = {
     str(item): endpoint
-    for endpoint, items in list(ITEM_LOOKUP.items())[::-1]
+    for endpoint, items in reversed(ITEM_LOOKUP.items())
     for item in items
 }
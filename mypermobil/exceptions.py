@@ -6,6 +6,10 @@ class MyPermobilAPIException(MyPermobilException):
     """Permobil Exception. Exception raised when the API returns an error."""
 
 
+class MyPermobilServerException(MyPermobilAPIException):
+    """Permobil Exception. Exception raised when the API returns a 5xx error."""
+
+
 class MyPermobilConnectionException(MyPermobilException):
     """Permobil Exception. Exception raised when the AIOHTTP."""
 
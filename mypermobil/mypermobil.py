@@ -2,17 +2,26 @@
 
 import asyncio
 import datetime
-import re
+import itertools
+import threading
+import weakref
+from collections.abc import Mapping
 
 import aiohttp
 from aiocache import Cache
+from aiocache.plugins import BasePlugin
+
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson is optional, fall back to the standard library
+    from json import loads as json_loads
 
 from .exceptions import (
     MyPermobilAPIException,
     MyPermobilConnectionException,
     MyPermobilClientException,
     MyPermobilEulaException,
-    MyPermobilNoProductException,
+    MyPermobilServerException,
 )
 
 from .const import (
@@ -23,10 +32,11 @@ from .const import (
     ENDPOINT_BATTERY_INFO,
     ENDPOINT_DAILY_USAGE,
     ENDPOINT_VA_USAGE_RECORDS,
+    ENDPOINT_VA_CHAIR_STATUS,
+    ENDPOINT_VA_CHARGE_TIME,
     ENDPOINT_PRODUCTS_POSITIONS,
     PRODUCTS_ID,
     GET_REGIONS,
-    EMAIL_REGEX,
     GET,
     POST,
     PUT,
@@ -34,10 +44,53 @@ from .const import (
 )
 
 
-CACHE: Cache = Cache()
+class CacheSizePlugin(BasePlugin):
+    """Cache plugin that evicts the least recently set entries when full."""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+
+    async def post_set(self, client, key, *args, namespace=None, **kwargs):
+        """Mark the key as most recently set, then evict if over max size."""
+        if namespace is None:
+            namespace = client.namespace
+        cache_key = client.build_key(key, namespace=namespace)
+        # the memory backend overwrites keys in place, move the key to the end
+        stored = await client.raw("pop", cache_key, None)
+        if stored is not None:
+            await client.raw("__setitem__", cache_key, stored)
+
+        keys = await client.raw("keys")
+        while len(keys) > self.max_size:
+            await client.delete(next(iter(keys)))
+
+
+CACHE_MAX_SIZE = 512
+CACHE: Cache = Cache(plugins=[CacheSizePlugin(CACHE_MAX_SIZE)])
 CACHE_TTL = 5 * 60  # 5 minutes
 CACHE_ERROR_TTL = 10  # 10 seconds
+CACHE_STALE_TTL = CACHE_TTL * 12  # 1 hour, used when falling back on errors
+CACHE_FALLBACK_EXCEPTIONS = (MyPermobilConnectionException, MyPermobilServerException)
+CACHE_REGIONS_TTL = 60 * 60  # 1 hour
+# endpoints not listed here use CACHE_TTL
+CACHE_TTL_BY_ENDPOINT = {
+    ENDPOINT_VA_CHAIR_STATUS: 10,  # changes by the minute
+    ENDPOINT_VA_CHARGE_TIME: 30,
+    ENDPOINT_BATTERY_INFO: 30,
+    ENDPOINT_PRODUCTS: 30 * 60,  # rarely changes
+}
 CACHE_LOCKS = {}
+# unlike id(), these are never reused by a later instance
+CACHE_IDS = itertools.count()
+
+# one session per event loop, a session cannot be shared between loops. The
+# sessions are held weakly, an entry is dropped once no client uses the session
+SESSIONS: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+SESSIONS_LOCK = threading.Lock()
+CONNECTOR_LIMIT = 256
+CONNECTOR_LIMIT_PER_HOST = 64
+CONNECTOR_DNS_CACHE_TTL = 300  # 5 minutes
+CONNECTOR_KEEPALIVE_TIMEOUT = 75  # seconds
 
 
 async def async_get_cache(key):
@@ -50,75 +103,160 @@ async def async_get_cache(key):
     return res
 
 
-def cacheable(func):
+def freeze(value):
+    """Convert mappings, lists and sets into hashable values for cache keys."""
+    if isinstance(value, Mapping):
+        items = ((key, freeze(val)) for key, val in value.items())
+        return tuple(sorted(items, key=repr))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(val) for val in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(freeze(val) for val in value)
+    try:
+        hash(value)
+    except TypeError:
+        # other unhashable values are keyed on their repr
+        return repr(value)
+    return value
+
+
+def make_cache_key(func, args, kwargs) -> tuple:
+    """Build a hashable cache key for a function call."""
+    if args and isinstance(args[0], MyPermobil):
+        # key methods on the instance id, never on the instance and its token
+        instance, args = args[0], args[1:]
+        own_headers = instance.auth_headers
+        if own_headers is not None:
+            # the instance's own headers hold the token, the id already covers them
+            args = tuple(None if arg == own_headers else arg for arg in args)
+            kwargs = {
+                name: None if arg == own_headers else arg
+                for name, arg in kwargs.items()
+            }
+        return (func.__qualname__, instance.cache_id, freeze(args), freeze(kwargs))
+    return (func.__qualname__, freeze(args), freeze(kwargs))
+
+
+def cacheable(func=None, ttl: int = None):
     """Decorator to cache function calls for methods that
     fetch multiple data points from the API.
+
+    The response is cached for ttl seconds if given, otherwise for the
+    CACHE_TTL_BY_ENDPOINT entry of the endpoint argument or CACHE_TTL.
+
+    If the instance has fallback_on_error set, the last successful response
+    is kept for CACHE_STALE_TTL and returned instead of raising on connection
+    errors and 5xx responses.
     """
+    if func is None:
+        # used as @cacheable(ttl=...)
+        return lambda func: cacheable(func, ttl=ttl)
+
+    def get_ttl(args, kwargs) -> int:
+        """Get the ttl of a call."""
+        if ttl is not None:
+            return ttl
+        endpoint = kwargs.get("endpoint", args[1] if len(args) > 1 else None)
+        if not isinstance(endpoint, str):
+            return CACHE_TTL
+        return CACHE_TTL_BY_ENDPOINT.get(endpoint, CACHE_TTL)
 
     async def wrapper(*args, **kwargs):
         """wrapper."""
-        key = func.__name__ + str(args) + str(kwargs)
+        key = make_cache_key(func, args, kwargs)
+        stale_key = ("stale", key)
         # check if the request is already cached
         cached_data = await async_get_cache(key)
         if cached_data:
             # return cached data
             return cached_data
 
-        # check if the request is already in progress
-        if key in CACHE_LOCKS:
+        # claim the request, unless another task is already making it. setdefault
+        # does the check and the claim in one step, without yielding to the loop
+        lock = asyncio.Event()
+        current_lock = CACHE_LOCKS.setdefault(key, lock)
+        if current_lock is not lock:
             # request is already in progress, wait for it to finish
-            await CACHE_LOCKS[key].wait()
+            await current_lock.wait()
             res = await async_get_cache(key)
             return res  # return cached data once it has finished by other task
 
-        # start request it and lock other requests from starting
-        CACHE_LOCKS[key] = asyncio.Event()
-
         try:
-            response = await func(*args, **kwargs)  # make the request
-            await CACHE.set(key, response, ttl=CACHE_TTL)  # cache the response
-        except Exception as err:  # pylint: disable=broad-except
-            # if there is an error, cache the error and raise it
-            await CACHE.set(key, err, ttl=CACHE_ERROR_TTL)
-            raise err
+            # another task may have cached the data while the cache was checked
+            cached_data = await async_get_cache(key)
+            if cached_data:
+                return cached_data
+            fallback = bool(args) and getattr(args[0], "fallback_on_error", False)
+            try:
+                response = await func(*args, **kwargs)  # make the request
+                # cache the response
+                await CACHE.set(key, response, ttl=get_ttl(args, kwargs))
+                if fallback and response:
+                    # an empty response must not replace the last good one
+                    await CACHE.set(stale_key, response, ttl=CACHE_STALE_TTL)
+            except Exception as err:  # pylint: disable=broad-except
+                if fallback and isinstance(err, CACHE_FALLBACK_EXCEPTIONS):
+                    stale_data = await CACHE.get(stale_key)
+                    if stale_data:
+                        # serve the last successful response during the outage
+                        await CACHE.set(key, stale_data, ttl=CACHE_ERROR_TTL)
+                        return stale_data
+                # if there is an error, cache the error and raise it
+                await CACHE.set(key, err, ttl=CACHE_ERROR_TTL)
+                raise err
         finally:
             # regardless of the outcome, unlock other threads
-            CACHE_LOCKS[key].set()
+            lock.set()
             del CACHE_LOCKS[key]
         return response
 
     return wrapper
 
 
+# status codes with a known meaning, other errors use the message in the response
+RESPONSE_ERRORS = {
+    401: (MyPermobilAPIException, "Email not registered for region"),
+    403: (MyPermobilAPIException, "Incorrect code"),
+    430: (MyPermobilEulaException, "Please accept the EULA"),
+}
+
+
 async def parse_response(response) -> dict:
-    try:
-        res = await response.json()
-        status = response.status
-    except aiohttp.client_exceptions.ContentTypeError:
-        raise MyPermobilAPIException("Invalid formatted server response")
+    status = response.status
     if status == 200:
-        return res
-    elif status == 401:
-        raise MyPermobilAPIException("Email not registered for region")
-    elif status == 403:
-        raise MyPermobilAPIException("Incorrect code")
-    elif status == 430:
-        raise MyPermobilEulaException("Please accept the EULA")
-    elif status == 403:
-        raise MyPermobilNoProductException("Your account is not linked to a product")
-    else:
-        if 'error' in res:
-            raise MyPermobilAPIException(f"{status}: {res['error']}")
-        else:
-            text = await response.text()
-            raise MyPermobilAPIException(f"{status}: {text}")
-        
+        # only successful responses are decoded as json
+        try:
+            return await response.json(loads=json_loads)
+        except aiohttp.client_exceptions.ContentTypeError:
+            raise MyPermobilAPIException("Invalid formatted server response")
+    if status in RESPONSE_ERRORS:
+        exception, message = RESPONSE_ERRORS[status]
+        raise exception(message)
+
+    exception = MyPermobilAPIException
+    if status >= 500:
+        exception = MyPermobilServerException
+    # error bodies are not always json, e.g. html error pages
+    text = await response.text()
+    try:
+        error = json_loads(text).get("error", text)
+    except (ValueError, TypeError, AttributeError):
+        error = text
+    raise exception(f"{status}: {error}")
+
 
 def validate_email(email: str) -> str:
     """Validates an email."""
     if not email:
         raise MyPermobilClientException("Missing email")
-    if not re.match(EMAIL_REGEX, email):
+    # something before the @, a single @, and a dot with text on both sides after it
+    at_index = email.find("@")
+    if (
+        at_index <= 0
+        or email.find("@", at_index + 1) != -1
+        or email.find(".", at_index + 2) == -1
+        or email.endswith(".")
+    ):
         raise MyPermobilClientException("Invalid email")
     return email
 
@@ -127,12 +265,13 @@ def validate_code(code: str) -> str:
     """Validates an code."""
     if not code:
         raise MyPermobilClientException("Missing code")
-    if " " in code or "\n" in code:
-        raise MyPermobilClientException("Code cannot contain spaces or newlines")
-    if not code.isdigit():
-        raise MyPermobilClientException("Code must be a number")
+    # the length check is the cheapest and rejects most bad input
     if len(code) != 6:
         raise MyPermobilClientException("Code must be 6 digits long")
+    if not code.isdigit():
+        if " " in code or "\n" in code:
+            raise MyPermobilClientException("Code cannot contain spaces or newlines")
+        raise MyPermobilClientException("Code must be a number")
     return code
 
 
@@ -152,11 +291,14 @@ def validate_expiration_date(expiration_date: str) -> str:
         raise MyPermobilClientException("Missing expiration date")
     date = None
     try:
-        date = datetime.datetime.strptime(expiration_date, "%Y-%m-%d")
+        date = datetime.date.fromisoformat(expiration_date)
     except ValueError as err:
         raise MyPermobilClientException("Invalid expiration date") from err
-    # check if the expiration date is in the future
-    if date < datetime.datetime.now():
+    # fromisoformat also accepts other iso formats, such as 20991231 and 2099-W01-1
+    if date.isoformat() != expiration_date:
+        raise MyPermobilClientException("Invalid expiration date")
+    # check if the expiration date is in the future, the token expires at midnight
+    if date <= datetime.date.today():
         raise MyPermobilClientException("Expired token")
     return expiration_date
 
@@ -165,7 +307,7 @@ def validate_region(region: str) -> str:
     """Validates an region."""
     if not region:
         raise MyPermobilClientException("Missing region")
-    if not region.startswith("https://") and not region.startswith("http://"):
+    if not region.startswith(("https://", "http://")):
         raise MyPermobilClientException("Region missing protocol")
     return region
 
@@ -180,14 +322,31 @@ def validate_product_id(product_id: str) -> str:
 
 
 async def create_session():
-    """Create a client session."""
-    return aiohttp.ClientSession()
+    """Create a client session, or reuse the open one of the running loop.
+
+    The session is shared by every caller on the same loop, so closing it
+    closes it for all of them.
+    """
+    loop = asyncio.get_running_loop()
+    with SESSIONS_LOCK:
+        session = SESSIONS.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=CONNECTOR_LIMIT,
+                limit_per_host=CONNECTOR_LIMIT_PER_HOST,
+                ttl_dns_cache=CONNECTOR_DNS_CACHE_TTL,
+                keepalive_timeout=CONNECTOR_KEEPALIVE_TIMEOUT,
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            SESSIONS[loop] = session
+    return session
 
 
 class MyPermobil:
     """Permobil API."""
 
     request_timeout = 10
+    max_concurrent_requests = 16
 
     def __init__(
         self,
@@ -199,6 +358,7 @@ class MyPermobil:
         token: str = None,
         expiration_date: str = None,
         product_id: str = None,
+        fallback_on_error: bool = False,
     ) -> None:
         """Initialize."""
         self.application = application
@@ -209,8 +369,14 @@ class MyPermobil:
         self.token = token
         self.expiration_date = expiration_date
         self.product_id = product_id
+        self.fallback_on_error = fallback_on_error
+        self.cache_id = next(CACHE_IDS)
+        self.request_semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        self.request_semaphore_size = self.max_concurrent_requests
+        self.client_timeout = aiohttp.ClientTimeout(total=self.request_timeout)
 
         self.authenticated = False
+        self.auth_headers = None
 
     # Magic methods
     def __str__(self) -> str:
@@ -225,7 +391,9 @@ class MyPermobil:
         """headers."""
         if not self.authenticated:
             raise MyPermobilClientException("Not authenticated")
-        return {"Authorization": f"Bearer {self.token}"}
+        if self.auth_headers is None:
+            self.auth_headers = {"Authorization": f"Bearer {self.token}"}
+        return self.auth_headers
 
     def set_email(self, email: str):
         """Set email."""
@@ -250,6 +418,7 @@ class MyPermobil:
         if self.authenticated:
             raise MyPermobilClientException("Cannot change token after authentication")
         self.token = validate_token(token)
+        self.auth_headers = None
 
     def set_expiration_date(self, expiration_date: str):
         """Set expiration date."""
@@ -285,6 +454,7 @@ class MyPermobil:
         validate_token(self.token)
         validate_expiration_date(self.expiration_date)
         self.authenticated = True
+        self.auth_headers = {"Authorization": f"Bearer {self.token}"}
 
     def self_reauthenticate(self):
         """Use when token is expired.
@@ -299,37 +469,53 @@ class MyPermobil:
         self.expiration_date = None
         self.code = None
         self.authenticated = False
+        self.auth_headers = None
 
     # API Methods
     async def make_request(self, request_type: str, *args, **kwargs):
         """make a post, get, put or delete request"""
         if not kwargs.get("timeout"):
-            kwargs["timeout"] = self.request_timeout
+            if self.client_timeout.total != self.request_timeout:
+                # request_timeout was changed after construction
+                self.client_timeout = aiohttp.ClientTimeout(total=self.request_timeout)
+            kwargs["timeout"] = self.client_timeout
         if not kwargs.get("headers") and self.authenticated:
             kwargs["headers"] = self.headers
 
         if request_type not in (GET, POST, PUT, DELETE):
             raise MyPermobilClientException("Invalid request type")
 
-        try:
-            if request_type == GET:
-                return await self.session.get(*args, **kwargs)
-            if request_type == POST:
-                return await self.session.post(*args, **kwargs)
-            if request_type == PUT:
-                return await self.session.put(*args, **kwargs)
-            if request_type == DELETE:
-                return await self.session.delete(*args, **kwargs)
-        except aiohttp.ClientConnectorError as err:
-            raise MyPermobilConnectionException("Connection error") from err
-        except asyncio.TimeoutError as err:
-            raise MyPermobilConnectionException("Connection timeout") from err
-        except aiohttp.ClientError as err:
-            raise MyPermobilConnectionException("Client error") from err
-        except Exception as err:
-            raise MyPermobilAPIException("Unknown error") from err
-
-    @cacheable
+        if self.request_semaphore_size != self.max_concurrent_requests:
+            # max_concurrent_requests was changed after construction, requests
+            # already in flight release the old semaphore
+            self.request_semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+            self.request_semaphore_size = self.max_concurrent_requests
+
+        # bound the number of requests in flight at the same time
+        async with self.request_semaphore:
+            try:
+                if request_type == GET:
+                    response = await self.session.get(*args, **kwargs)
+                if request_type == POST:
+                    response = await self.session.post(*args, **kwargs)
+                if request_type == PUT:
+                    response = await self.session.put(*args, **kwargs)
+                if request_type == DELETE:
+                    response = await self.session.delete(*args, **kwargs)
+                # read the body while limited, the connection is in use until then.
+                # aiohttp keeps the body, so json() and text() do not read it again
+                await response.read()
+                return response
+            except aiohttp.ClientConnectorError as err:
+                raise MyPermobilConnectionException("Connection error") from err
+            except asyncio.TimeoutError as err:
+                raise MyPermobilConnectionException("Connection timeout") from err
+            except aiohttp.ClientError as err:
+                raise MyPermobilConnectionException("Client error") from err
+            except Exception as err:
+                raise MyPermobilAPIException("Unknown error") from err
+
+    @cacheable(ttl=CACHE_REGIONS_TTL)
     async def request_regions(
         self, include_icons: bool = False, include_internal: bool = False
     ):
@@ -339,28 +525,28 @@ class MyPermobil:
 
         response = await self.make_request(GET, GET_REGIONS, headers={})
         if response.status == 200:
-            response_json = await response.json()
+            response_json = await response.json(loads=json_loads)
             regions = {}
             for region in response_json:
+                port = region.get("backendPort")
                 if not include_internal:
-                    if (
-                        region.get("backendPort") != 443
-                        or region.get("serverType") != "Production"
-                    ):
+                    if port != 443 or region.get("serverType") != "Production":
                         continue
-                region_id = region.get("_id")
-                regions[region_id] = {}
-                regions[region_id]["name"] = region.get("name")
-                regions[region_id]["port"] = region.get("backendPort")
-                protocol = "https" if region.get("backendPort") == 443 else "http"
-                regions[region_id]["url"] = f"{protocol}://{region.get('host')}"
+                protocol = "https" if port == 443 else "http"
+                region_data = {
+                    "name": region.get("name"),
+                    "port": port,
+                    "url": f"{protocol}://{region.get('host')}",
+                }
                 if include_icons:
-                    regions[region_id]["icon"] = region.get("flag")
+                    region_data["icon"] = region.get("flag")
+                regions[region.get("_id")] = region_data
             return regions
 
-        if response.status in (404, 500):
-            text = await response.text()
-            raise MyPermobilAPIException(text)
+        text = await response.text()
+        if response.status >= 500:
+            raise MyPermobilServerException(text)
+        raise MyPermobilAPIException(text)
 
     async def request_region_names(self, include_internal: bool = False):
         """Get region names."""
@@ -416,9 +602,8 @@ class MyPermobil:
             application = self.application
         if expiration_date is None:
             # set expiration date to 1 year from now
-            time_delta = datetime.timedelta(days=365)
-            date = datetime.datetime.now() + time_delta
-            expiration_date = date.strftime("%Y-%m-%d")
+            date = datetime.date.today() + datetime.timedelta(days=365)
+            expiration_date = date.isoformat()
 
         if self.authenticated:
             raise MyPermobilClientException("Already authenticated")
@@ -496,9 +681,8 @@ class MyPermobil:
 
         if endpoint is None:
             key = str(items)
-            if key in ENDPOINT_LOOKUP:
-                endpoint = ENDPOINT_LOOKUP.get(key)
-            else:
+            endpoint = ENDPOINT_LOOKUP.get(key)
+            if endpoint is None:
                 raise MyPermobilClientException(f"No endpoint for: {key}")
 
         # dive into the response for each item in the list
@@ -5,16 +5,21 @@ import datetime
 import unittest
 import aiohttp
 import asyncio
-from unittest.mock import AsyncMock
+from multidict import CIMultiDict
+from unittest.mock import AsyncMock, patch
+from mypermobil.mypermobil import CACHE, CACHE_TTL_BY_ENDPOINT, make_cache_key
 from mypermobil import (
     MyPermobil,
     MyPermobilClientException,
     MyPermobilAPIException,
     MyPermobilConnectionException,
+    MyPermobilServerException,
     BATTERY_AMPERE_HOURS_LEFT,
     RECORDS_DISTANCE,
     RECORDS_SEATING,
     ENDPOINT_VA_USAGE_RECORDS,
+    ENDPOINT_VA_CHAIR_STATUS,
+    STATUS_STATUS,
     GET,
     POST,
     DELETE,
@@ -37,6 +42,11 @@ class TestRequest(aiounittest.AsyncTestCase):
         )
         self.api.self_authenticate()
 
+    async def test_headers_cached(self):
+        headers = self.api.headers
+        assert headers == {"Authorization": f"Bearer {self.api.token}"}
+        assert self.api.headers is headers
+
     async def test_request_item(self):
         resp = AsyncMock(status=200)
         resp.json = AsyncMock(return_value={BATTERY_AMPERE_HOURS_LEFT[0]: 123})
@@ -96,6 +106,22 @@ class TestRequest(aiounittest.AsyncTestCase):
         with self.assertRaises(MyPermobilAPIException):
             await self.api.request_endpoint("endpoint")
 
+    async def test_request_endpoint_error_body(self):
+        resp = AsyncMock(status=500)
+        resp.text = AsyncMock(return_value="<html>Server error</html>")
+        self.api.make_request = AsyncMock(return_value=resp)
+        with self.assertRaises(MyPermobilServerException) as err:
+            await self.api.request_endpoint("html endpoint")
+        assert str(err.exception) == "500: <html>Server error</html>"
+        resp.json.assert_not_called()
+
+        resp = AsyncMock(status=400)
+        resp.text = AsyncMock(return_value='{"error": "bad request"}')
+        self.api.make_request = AsyncMock(return_value=resp)
+        with self.assertRaises(MyPermobilAPIException) as err:
+            await self.api.request_endpoint("json endpoint")
+        assert str(err.exception) == "400: bad request"
+
     #    async def test_request_non_existent_endpoint(self):
     #        endpoint = "this endpoint does not exist"
     #        item = "invalid item"
@@ -127,7 +153,7 @@ class TestRequest(aiounittest.AsyncTestCase):
     async def test_request_request_endpoint_async(self):
         """call the same endpoint twice and check that the cache is used"""
 
-        async def delay():
+        async def delay(**kwargs):
             await asyncio.sleep(0.5)
             return {RECORDS_DISTANCE[0]: 123, RECORDS_SEATING[0]: 456}
 
@@ -144,6 +170,104 @@ class TestRequest(aiounittest.AsyncTestCase):
         assert self.api.make_request.call_count == 1
         assert self.api.make_request.call_args[0][1].endswith(ENDPOINT_VA_USAGE_RECORDS)
 
+    async def test_cache_key_excludes_token(self):
+        headers = self.api.headers
+        key = make_cache_key(
+            self.api.request_endpoint, (self.api, "endpoint", headers), {}
+        )
+        assert hash(key)
+        assert self.api.token not in repr(key)
+        assert self.api not in key
+
+        key = make_cache_key(
+            self.api.request_endpoint, (self.api, "endpoint"), {"headers": headers}
+        )
+        assert self.api.token not in repr(key)
+
+    async def test_request_endpoint_multidict_headers(self):
+        resp = AsyncMock(status=200)
+        resp.json = AsyncMock(return_value={RECORDS_DISTANCE[0]: 123})
+        self.api.make_request = AsyncMock(return_value=resp)
+        headers = CIMultiDict(Authorization=f"Bearer {self.api.token}")
+
+        res1 = await self.api.request_endpoint("/multidict", headers=headers)
+        res2 = await self.api.request_endpoint("/multidict", headers=headers)
+
+        assert res1 == res2 == {RECORDS_DISTANCE[0]: 123}
+        assert self.api.make_request.call_count == 1
+
+    async def test_request_product_id_cache_key_excludes_token(self):
+        resp = AsyncMock(status=200)
+        resp.json = AsyncMock(return_value=[{"_id": "a" * 24}])
+        self.api.make_request = AsyncMock(return_value=resp)
+
+        with patch.object(CACHE, "set", AsyncMock()) as cache_set:
+            await self.api.request_product_id()
+
+        assert cache_set.call_count > 0
+        for call in cache_set.call_args_list:
+            assert self.api.token not in repr(call.args[0])
+
+    async def test_request_item_concurrent(self):
+        """concurrent items from the same endpoint share one upstream request"""
+        resp = AsyncMock(status=200)
+        resp.json = AsyncMock(
+            return_value={RECORDS_DISTANCE[0]: 123, RECORDS_SEATING[0]: 456}
+        )
+        self.api.make_request = AsyncMock(return_value=resp)
+
+        res = await asyncio.gather(
+            self.api.request_item(RECORDS_DISTANCE),
+            self.api.request_item(RECORDS_SEATING),
+            self.api.request_item(RECORDS_DISTANCE),
+        )
+
+        assert res == [123, 456, 123]
+        assert self.api.make_request.call_count == 1
+
+    async def test_request_endpoint_ttl(self):
+        resp = AsyncMock(status=200)
+        resp.json = AsyncMock(return_value={STATUS_STATUS[0]: "ok"})
+        self.api.make_request = AsyncMock(return_value=resp)
+
+        with patch.object(CACHE, "set", AsyncMock()) as cache_set:
+            await self.api.request_endpoint(ENDPOINT_VA_CHAIR_STATUS)
+
+        ttl = cache_set.call_args_list[0].kwargs["ttl"]
+        assert ttl == CACHE_TTL_BY_ENDPOINT[ENDPOINT_VA_CHAIR_STATUS]
+
+    async def test_request_endpoint_cache_race(self):
+        """a caller that misses the cache and resumes after the request finished"""
+        resp = AsyncMock(status=200)
+        resp.json = AsyncMock(return_value={RECORDS_DISTANCE[0]: 123})
+        self.api.make_request = AsyncMock(return_value=resp)
+
+        cache_get = CACHE.get
+        reached, release = asyncio.Event(), asyncio.Event()
+        calls = 0
+
+        async def slow_get(key, *args, **kwargs):
+            nonlocal calls
+            calls += 1
+            res = await cache_get(key, *args, **kwargs)
+            if calls == 1:
+                # the first lookup misses, then yields until the request is done
+                reached.set()
+                await release.wait()
+            return res
+
+        with patch.object(CACHE, "get", slow_get):
+            late_task = asyncio.create_task(
+                self.api.request_endpoint(ENDPOINT_VA_USAGE_RECORDS)
+            )
+            await reached.wait()
+            res1 = await self.api.request_endpoint(ENDPOINT_VA_USAGE_RECORDS)
+            release.set()
+            res2 = await late_task
+
+        assert res1 == res2 == {RECORDS_DISTANCE[0]: 123}
+        assert self.api.make_request.call_count == 1
+
     async def test_request_request_endpoint_cache_exception(self):
         status = 404
         msg = "not found"
@@ -159,6 +283,56 @@ class TestRequest(aiounittest.AsyncTestCase):
         assert self.api.make_request.call_count == 1
         assert self.api.make_request.call_args[0][1].endswith(ENDPOINT_VA_USAGE_RECORDS)
 
+    async def test_request_endpoint_fallback_on_error(self):
+        self.api.fallback_on_error = True
+        resp = AsyncMock(status=200)
+        resp.json = AsyncMock(return_value={RECORDS_DISTANCE[0]: 123})
+        self.api.make_request = AsyncMock(return_value=resp)
+
+        with patch("mypermobil.mypermobil.CACHE_TTL", 0.01):
+            res1 = await self.api.request_item(RECORDS_DISTANCE)
+        await asyncio.sleep(0.05)  # let the fresh entry expire
+
+        self.api.make_request = AsyncMock(
+            side_effect=MyPermobilConnectionException("Connection error")
+        )
+        res2 = await self.api.request_item(RECORDS_DISTANCE)
+
+        assert res1 == res2 == 123
+        assert self.api.make_request.call_count == 1
+
+    async def test_request_endpoint_fallback_keeps_last_good(self):
+        self.api.fallback_on_error = True
+        good = AsyncMock(status=200)
+        good.json = AsyncMock(return_value={RECORDS_DISTANCE[0]: 123})
+        empty = AsyncMock(status=200)
+        empty.json = AsyncMock(return_value={})
+
+        with patch("mypermobil.mypermobil.CACHE_TTL", 0.01):
+            self.api.make_request = AsyncMock(return_value=good)
+            await self.api.request_endpoint(ENDPOINT_VA_USAGE_RECORDS)
+            await asyncio.sleep(0.05)
+            self.api.make_request = AsyncMock(return_value=empty)
+            await self.api.request_endpoint(ENDPOINT_VA_USAGE_RECORDS)
+            await asyncio.sleep(0.05)
+
+        self.api.make_request = AsyncMock(
+            side_effect=MyPermobilConnectionException("Connection error")
+        )
+        res = await self.api.request_endpoint(ENDPOINT_VA_USAGE_RECORDS)
+        assert res == {RECORDS_DISTANCE[0]: 123}
+
+    async def test_request_endpoint_no_stale_without_fallback(self):
+        resp = AsyncMock(status=200)
+        resp.json = AsyncMock(return_value={RECORDS_DISTANCE[0]: 123})
+        self.api.make_request = AsyncMock(return_value=resp)
+
+        with patch.object(CACHE, "set", AsyncMock()) as cache_set:
+            await self.api.request_endpoint(ENDPOINT_VA_USAGE_RECORDS)
+
+        assert cache_set.call_count == 1
+        assert cache_set.call_args.args[0][0] != "stale"
+
     async def test_request_get_request(self):
         session = AsyncMock(status=200)
         session.get = AsyncMock(return_value=AsyncMock(status=200))
@@ -166,6 +340,62 @@ class TestRequest(aiounittest.AsyncTestCase):
 
         res = await self.api.make_request(GET, "http://example.com")
         assert res.status == 200
+        timeout = session.get.call_args.kwargs["timeout"]
+        assert timeout.total == self.api.request_timeout
+
+    async def test_request_concurrency_limit(self):
+        in_flight = []
+        max_in_flight = 0
+
+        async def get(*args, **kwargs):
+            nonlocal max_in_flight
+            in_flight.append(1)
+            max_in_flight = max(max_in_flight, len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.pop()
+            return AsyncMock(status=200)
+
+        session = AsyncMock()
+        session.get = get
+        self.api.session = session
+        self.api.max_concurrent_requests = 2
+
+        await asyncio.gather(
+            *[self.api.make_request(GET, "http://example.com") for _ in range(5)]
+        )
+        assert max_in_flight == 2
+
+    async def test_request_concurrency_limit_body(self):
+        """the body is read before the request slot is released"""
+        reading = asyncio.Event()
+        release = asyncio.Event()
+
+        async def read():
+            reading.set()
+            await release.wait()
+
+        response = AsyncMock(status=200)
+        response.read = read
+        session = AsyncMock()
+        session.get = AsyncMock(return_value=response)
+        self.api.session = session
+        self.api.max_concurrent_requests = 1
+
+        task = asyncio.create_task(self.api.make_request(GET, "http://example.com"))
+        await reading.wait()
+        assert self.api.request_semaphore.locked()
+        release.set()
+        assert await task is response
+        assert not self.api.request_semaphore.locked()
+
+    async def test_request_timeout_changed(self):
+        session = AsyncMock()
+        session.get = AsyncMock(return_value=AsyncMock(status=200))
+        self.api.session = session
+
+        self.api.request_timeout = 30
+        await self.api.make_request(GET, "http://example.com")
+        assert session.get.call_args.kwargs["timeout"].total == 30
 
     async def test_request_get_request_exceptions(self):
         session = AsyncMock()
@@ -1,10 +1,19 @@
 """ test auth control flow """
 
 import aiounittest
+import asyncio
 import datetime
+import gc
 import unittest
 from unittest.mock import MagicMock, AsyncMock
-from mypermobil import MyPermobil, MyPermobilClientException, MyPermobilAPIException
+from aiocache import Cache
+from mypermobil.mypermobil import CacheSizePlugin, SESSIONS
+from mypermobil import (
+    MyPermobil,
+    create_session,
+    MyPermobilClientException,
+    MyPermobilAPIException,
+)
 
 
 # pylint: disable=missing-docstring
@@ -27,6 +36,44 @@ class TestAuth(aiounittest.AsyncTestCase):
         with self.assertRaises(MyPermobilClientException):
             await self.api.close_session()
 
+    async def test_create_session_reuse(self):
+        session = await create_session()
+        assert await create_session() is session
+
+        await session.close()
+        new_session = await create_session()
+        assert new_session is not session
+        await new_session.close()
+
+    def test_create_session_released(self):
+        async def open_session():
+            await (await create_session()).close()
+
+        for _ in range(3):
+            asyncio.run(open_session())
+        gc.collect()
+        assert len(SESSIONS) == 0
+
+    async def test_cache_size_plugin(self):
+        cache = Cache(plugins=[CacheSizePlugin(2)])
+        for key in ("a", "b", "c"):
+            await cache.set(key, key)
+
+        assert await cache.get("a") is None
+        assert await cache.get("b") == "b"
+        assert await cache.get("c") == "c"
+
+    async def test_cache_size_plugin_reset_key(self):
+        cache = Cache(plugins=[CacheSizePlugin(2)])
+        await cache.set("a", "a")
+        await cache.set("b", "b")
+        await cache.set("a", "new a", ttl=10)  # a is now the most recently set
+        await cache.set("c", "c")
+
+        assert await cache.get("a") == "new a"
+        assert await cache.get("b") is None
+        assert await cache.get("c") == "c"
+
 
 if __name__ == "__main__":
     unittest.main()
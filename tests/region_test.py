@@ -4,7 +4,12 @@ import asyncio
 import unittest
 from unittest.mock import AsyncMock
 
-from mypermobil import MyPermobil, create_session, MyPermobilAPIException
+from mypermobil import (
+    MyPermobil,
+    create_session,
+    MyPermobilAPIException,
+    MyPermobilServerException,
+)
 
 
 class TestRegion(unittest.TestCase):
@@ -41,9 +46,55 @@ class TestRegion(unittest.TestCase):
             with self.assertRaises(MyPermobilAPIException):
                 await api.request_regions(include_icons=True)
 
+            response.status = 503
+            api = MyPermobil("test", session)
+            with self.assertRaises(MyPermobilServerException):
+                await api.request_regions(include_icons=True)
+
+            for status in (401, 403, 429):
+                response.status = status
+                api = MyPermobil("test", session)
+                with self.assertRaises(MyPermobilAPIException):
+                    await api.request_regions(include_icons=True)
+
+        async def region_parse():
+            """Test parsing the region response"""
+            response = AsyncMock(status=200)
+            response.json = AsyncMock(
+                return_value=[
+                    {
+                        "_id": "1",
+                        "name": "Europe",
+                        "host": "eu.example.com",
+                        "backendPort": 443,
+                        "serverType": "Production",
+                        "flag": "icon",
+                    },
+                    {
+                        "_id": "2",
+                        "name": "Internal",
+                        "host": "dev.example.com",
+                        "backendPort": 80,
+                        "serverType": "Development",
+                    },
+                ]
+            )
+            api = MyPermobil("test", AsyncMock())
+            api.make_request = AsyncMock(return_value=response)
+            regions = await api.request_regions(include_icons=True)
+            assert regions == {
+                "1": {
+                    "name": "Europe",
+                    "port": 443,
+                    "url": "https://eu.example.com",
+                    "icon": "icon",
+                }
+            }
+
+        asyncio.run(region_parse())
+        asyncio.run(region_error())
         asyncio.run(region_name_test())
         asyncio.run(region_with_flags())
-        asyncio.run(region_error())
 
 
 if __name__ == "__main__":
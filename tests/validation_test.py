@@ -24,6 +24,10 @@ class TestAuth(aiounittest.AsyncTestCase):
         with self.assertRaises(MyPermobilClientException):
             self.api.set_email(email)
 
+        for email in ("@email.com", "valid@.com", "valid@email.", "a@b@email.com"):
+            with self.assertRaises(MyPermobilClientException):
+                self.api.set_email(email)
+
         email = ""
         with self.assertRaises(MyPermobilClientException):
             self.api.set_email(email)
@@ -40,6 +44,10 @@ class TestAuth(aiounittest.AsyncTestCase):
         with self.assertRaises(MyPermobilClientException):
             self.api.set_expiration_date(expiration_date)
 
+        for expiration_date in ("20991231", "2099-W01-1", "2099-12-31T00:00"):
+            with self.assertRaises(MyPermobilClientException):
+                self.api.set_expiration_date(expiration_date)
+
         expiration_date = prev_date.strftime("%Y-%m-%d")
         with self.assertRaises(MyPermobilClientException):
             self.api.set_expiration_date(expiration_date)